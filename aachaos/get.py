@@ -1,17 +1,55 @@
 """Module facilitates fetching account data into a simplified form.
+
+pandas is only imported by the methods returning DataFrames/Series,
+so the fetch and store path (`main update`) doesn't pay for it.
 """
+import io
 import os
-import xml.etree.ElementTree as ET
+import stat
+import functools
 from collections import namedtuple
 from datetime import datetime
 
-import pandas as pd
 import requests
+import requests.adapters
+
+# Prefer lxml's C parser where available; the API used is the same.
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 import aachaos.store
 from aachaos.config import settings
 
 URL_CHAOS = 'https://chaos.aa.net.uk/'
+HTTP_TIMEOUT = (3, 10) # s, (connect, read)
+
+# Namespaced tag of the line info element in API responses.
+_BB_TAG = '{{{}}}broadband'.format(URL_CHAOS)
+
+
+def _make_session():
+    # Keep-alive session shared by API requests so repeated fetches
+    # reuse the TCP connection and TLS session.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=4)
+    session.mount(URL_CHAOS, adapter)
+    return session
+
+
+_SESSION = _make_session()
+
+
+def set_session(session):
+    """Use `session` (a `requests.Session`) for all API requests.
+
+    Allows callers to share a session (and its connection pool) with
+    their own requests.
+    """
+    global _SESSION
+    _SESSION = session
 
 
 class DatabaseEmptyException(Exception): pass
@@ -29,50 +67,72 @@ class LineInfo(object):
     class AuthenticationError(Exception): pass
 
     def __init__(self, user, passwd):
-        self.xml = xml = self.fetch(user, passwd)
-        self.parse(xml)
+        # Closing the response returns its connection to the session's
+        # pool, however parsing goes.
+        response = self.fetch(user, passwd)
+        with response:
+            self.parse(response.raw)
 
     @property
     def quota(self):
         return self._quota
 
     def fetch(self, user, passwd):
-        """Fetch the XML and load content into a LineInfo object."""
-        response = requests.get('{}info'.format(URL_CHAOS),
-                                auth=(user, passwd))
-        xml = response.text
-        # TODO: Move the following into own function when refactoring.
-        root = ET.fromstring(xml)
-        if root.get('error'):
-            raise self.AuthenticationError("%s/%s" % (user, passwd))
-        return xml
+        """Request line info, returning the (streamed) response.
+
+        The body isn't read into memory; `response.raw` is the XML
+        stream for `parse`. The caller should close the response.
+        Raises `requests.HTTPError` for an error status.
+        """
+        response = _SESSION.get('{}info'.format(URL_CHAOS),
+                                auth=(user, passwd), stream=True,
+                                timeout=HTTP_TIMEOUT)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        response.raw.decode_content = True
+        return response
 
     def parse(self, xml):
-        """Parse line information contained in an XML string.
+        """Parse line information from an XML string or stream.
 
         Method stores the content in local attributes (currently
         limited to a Quota object assigned to `_quota`).
         """
-        root = ET.fromstring(xml)
-
-        bb_lines = root.findall(
-            './/{{{}}}broadband'.format(URL_CHAOS)
-        )
+        if isinstance(xml, str):
+            xml = xml.encode()
+        if isinstance(xml, bytes):
+            xml = io.BytesIO(xml)
+
+        # Elements are discarded as they're parsed; we only need the
+        # root (to check for an error) and the broadband element's
+        # attributes. The whole document is read to confirm there's
+        # exactly one line.
+        root = None
+        bb_lines = []
+        for event, element in ET.iterparse(xml, events=('start', 'end')):
+            if root is None:
+                root = element
+                if root.get('error'):
+                    raise self.AuthenticationError(root.get('error'))
+            elif event == 'end':
+                if element.tag == _BB_TAG:
+                    bb_lines.append(dict(element.items()))
+                element.clear()
 
         if len(bb_lines) != 1:
             msg = "No. broadband elements != 1"
             raise NotImplementedError(msg)
 
-        # We should now have an element with information stored as
-        # key:value attribute pairs.
-        element = bb_lines[0]
-        d = dict(element.items())
+        # We should now have the line information stored as key:value
+        # attribute pairs.
+        d = bb_lines[0]
 
         # Create the quota object
-        q_tstamp = datetime.strptime(
-            d['quota-time'],
-            '%Y-%m-%d %H:%M:%S'
-        )
+        # 'YYYY-MM-DD HH:MM:SS' is ISO format; avoids strptime.
+        q_tstamp = datetime.fromisoformat(d['quota-time'])
         q_left = int(d['quota-left']) # bytes
         q_tot = int(d['quota-monthly']) # bytes
         self._quota = Quota(q_tstamp, q_left, q_tot)
@@ -88,28 +148,50 @@ class LineInfo(object):
 class DB(aachaos.store.DB):
     """Extends `store.DB` with data retrieval methods."""
 
+    # (data version, DataFrame) from the last `select_from_quota_vw`.
+    _vw_cache = None
+
     def select_from_quota_vw(self):
-        """Return contents of `quota_vw` as a pd DataFrame."""
-        cursor = self.execute(
-            "SELECT * FROM quota_vw ORDER BY timestamp ASC"
+        """Return contents of `quota_vw` as a pd DataFrame.
+
+        The DataFrame is cached and returned again (the same object)
+        until the database changes, so callers shouldn't modify it.
+        Only committed data is cached; within a transaction, the view
+        is always re-read.
+        """
+        import pandas as pd
+        version = None
+        if not self.in_transaction:
+            # data_version changes on commits by other connections
+            # (incl. other processes); total_changes on changes by
+            # this one.
+            version = (self.execute("PRAGMA data_version").fetchone()[0],
+                       self.total_changes)
+            cached = self._vw_cache
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        df = pd.read_sql_query(
+            "SELECT * FROM quota_vw ORDER BY timestamp ASC",
+            self,
+            index_col='timestamp',
+            parse_dates={'timestamp': {'unit': 's'}}
         )
-        records = cursor.fetchall()
+        if version is not None:
+            self._vw_cache = (version, df)
+        return df
 
-        column_names = [tup[0] for tup in cursor.description]
-        df = pd.DataFrame.from_records(records,
-                                       columns=column_names)
-        df['timestamp'] = pd.DatetimeIndex(df['timestamp'])
-        return df.set_index('timestamp')
+    def _invalidate(self):
+        self._vw_cache = None
+        super()._invalidate()
 
     def select_last_from_quota_vw(self):
         cursor = self.execute(
             """
             SELECT timestamp, percent
             FROM quota_vw
-            WHERE timestamp = (
-                SELECT max(timestamp)
-                FROM quota_vw
-            )
+            ORDER BY timestamp DESC
+            LIMIT 1
             """
         )
         pair = cursor.fetchone()
@@ -135,6 +217,10 @@ class Credentials(object):
 
     auth_path = os.path.join(settings.xdg_config, __package__, 'auth')
 
+    # Parsed credentials by file path, with the file's identity
+    # (inode, mtime) when read.
+    _cache = {}
+
     def __init__(self, user=None, passwd=None):
         if self._userpasswd_provided(user, passwd):
             self.user, self.passwd = user, passwd
@@ -145,20 +231,35 @@ class Credentials(object):
     def _userpasswd_provided(user, passwd):
         return user is not None and passwd is not None
 
-    def _auth_file_present(self):
-        return os.path.isfile(self.auth_path)
-
-    def _permissions_ok(self):
-        return oct(os.stat(self.auth_path).st_mode & 0o777) == '0o600'
-
     def retrieve(self):
-        if not self._auth_file_present():
+        # The file is opened once; the checks use the open descriptor
+        # and the contents are only read if not already cached. The
+        # open doesn't block, so e.g. a FIFO is rejected rather than
+        # waited on.
+        try:
+            fd = os.open(self.auth_path, os.O_RDONLY | os.O_NONBLOCK)
+        except FileNotFoundError:
             raise self.FileNotPresent
-        elif not self._permissions_ok():
+        except PermissionError:
             raise self.FileNotSecure
-        else:
-            with open(self.auth_path, 'r') as f:
-                return tuple(f.readline().strip().split(':'))
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode):
+                raise self.FileNotPresent
+            elif st.st_mode & 0o777 != 0o600:
+                raise self.FileNotSecure
+            key = (st.st_ino, st.st_mtime_ns)
+            cached = self._cache.get(self.auth_path)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            data = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+
+        line = data.decode().split('\n', 1)[0].strip()
+        userpasswd = tuple(line.split(':', 1))
+        self._cache[self.auth_path] = (key, userpasswd)
+        return userpasswd
 
 
 class History(object):
@@ -173,19 +274,41 @@ class History(object):
         'B' : 1
     }
 
-    def __init__(self):
-        self.db = DB()
+    def __init__(self, db=None):
+        if db is None:
+            db = aachaos.store.get_connection(DB)
+        self.db = db
+        DB.observers.add(self)
+
+    @functools.cached_property
+    def _df(self):
+        # Contents of `quota_vw`, queried once until invalidated.
+        return self.db.select_from_quota_vw()
+
+    def invalidate(self):
+        """Discard cached data so it's re-read on next access."""
+        self.__dict__.pop('_df', None)
 
     def quota(self, units='GB'):
         """The monthly quota (pd TimeSeries)."""
+        import numpy as np
+        import pandas as pd
         unitlu = self.units
-        df = self.db.select_from_quota_vw()
-        return df.total.resample('1M', kind='period') * unitlu[units]
+        df = self._df
+        # The total is fixed for each month; take the last value of
+        # each month. Rows are in timestamp order, so these are the
+        # rows followed by a change in month (or the end).
+        months = df.index.to_period('M')
+        codes = months.asi8
+        last = np.flatnonzero(np.append(codes[1:] != codes[:-1],
+                                        len(codes) > 0))
+        total = df.total.to_numpy()[last] * unitlu[units]
+        return pd.Series(total, index=months[last], name='total')
 
     def usage(self, units='GB'):
         """Quota remainder (pd TimeSeries)."""
         unitlu = self.units
-        df = self.db.select_from_quota_vw()
+        df = self._df
         return df.remaining * unitlu[units]
 
     def by_month(self, month=None, units='GB'):
@@ -200,16 +323,16 @@ class History(object):
             units : string (default 'GB')
                 Units of the data.
         """
+        import pandas as pd
         if month is None:
             month = datetime.today().strftime('%Y-%m')
         if not isinstance(month, pd.Period):
             month = pd.Period(month)
 
-        # Get the source data and filter for the specified month.
+        # Get the source data and slice out the specified month; the
+        # index is sorted, so its bounds are found by binary search.
         usage = self.usage(units)
-        indexes = usage.index.map(
-            lambda d: (d.year, d.month) == (month.year, month.month)
+        start, stop = usage.index.searchsorted(
+            [month.start_time, (month + 1).start_time]
         )
-        usage = usage[indexes]
-
-        return usage
+        return usage.iloc[start:stop]
@@ -6,21 +6,29 @@ Satisfies the following use-cases:
   - Retrieving data from the local data store.
 """
 import os
-import argparse
-from datetime import datetime
+import sys
+from datetime import datetime, timedelta
 from collections import namedtuple
+from types import SimpleNamespace
 
-import pandas as pd
-
-from aachaos import get, store, vis
+from aachaos import get, store
 from aachaos.config import settings
 
 T_ELAPSED_DEFAULT = 10800 # s, minimum elapsed time.
 
+# Time and percent remaining of the latest entry in the local store, as
+# last read or written by this process (see `Main._get_latest`).
+_latest = None
+
 
 class Main(object):
 
     path_fig = settings.get('Path', 'Figure')
+    # Sentinel file; its mtime is the earliest time of the next fetch.
+    path_next = os.path.join(settings.get('Path', 'Data'), 'next_fetch')
+    # Timestamp of the latest quota in the last figure drawn.
+    path_plotted = os.path.join(settings.get('Path', 'Data'), 'plotted')
+
     # ----------------------------------------------------------------
     # External methods / use cases
     # ----------------------------------------------------------------
@@ -45,27 +53,43 @@ class Main(object):
 
         quota = self._get_quota()
 
-        db = store.DB()
+        # Same (get.DB) connection as the interval check and plot.
+        db = store.get_connection(get.DB)
         db.insert_quota(*quota)
-        db.commit()
-
-        # Generate the latest figure as a side-effect.
+        global _latest
+        _latest = (quota.tstamp.replace(second=0, microsecond=0),
+                   quota.rem / quota.tot * 100)
+        self._set_next_fetch(*_latest)
+
+        # Nothing to redraw if the figure was drawn from this quota
+        # already (e.g. the API returned one that's already stored).
+        plotted = _latest[0].isoformat()
+        if (os.path.isfile(self.path_fig)
+                and self._get_last_plotted() == plotted):
+            return
+
+        # Generate the latest figure as a side-effect. Plotting modules
+        # are only imported when needed to keep start-up fast.
+        from aachaos import vis
         plotter = vis.Plotter()
         plotter.plot_month(datetime.today().strftime('%Y-%m'),
                            self.path_fig)
+        self._set_last_plotted(plotted)
 
     def data(self, args=None):
         """Retrieve data from local store."""
         # TODO: maybe allow optional file arg instead of stdout.
         # TODO: fix truncation of long data frames.
         # http://stackoverflow.com/q/19124601
-        db = get.DB()
+        db = store.get_connection(get.DB)
         print(db.select_from_quota_vw())
 
     def plot(self, args):
-        """Plot usage data for the current month."""
+        """Plot usage data for a month (default current)."""
+        from aachaos import vis
+        month = args.month or self._get_time_now().strftime('%Y-%m')
         plotter = vis.Plotter()
-        plotter.plot_month(month=args.month, fpath=args.file)
+        plotter.plot_month(month=month, fpath=args.file)
 
     # ----------------------------------------------------------------
     # Internal methods
@@ -102,26 +126,77 @@ class Main(object):
     @staticmethod
     def _get_time_left(now):
         """Return time left in period."""
-        delta = pd.Period(now.strftime('%Y-%m')).end_time - now
-        return delta.total_seconds()
+        year, month = divmod(now.month, 12)
+        next_month = datetime(now.year + year, month + 1, 1)
+        return (next_month - now).total_seconds()
 
     def _get_time_now(self):
         # Required for mocking; can't mock datetime.
         return datetime.now()
 
     def _get_latest(self):
-        """Get time and percent remaining from latest entry."""
-        db = get.DB()
-        time, rem = db.select_last_from_quota_vw()
-        return (time, rem)
+        """Get time and percent remaining from latest entry.
+
+        The store is only queried once per process; subsequent calls
+        return the entry last read or inserted by `update`.
+        """
+        global _latest
+        if _latest is None:
+            db = store.get_connection(get.DB)
+            _latest = db.select_last_from_quota_vw()
+        return _latest
+
+    def _set_next_fetch(self, time, rem):
+        # Record the earliest time the next fetch could be due. The
+        # interval only shrinks as the month runs out, so evaluating
+        # it at the end of the default interval (or of the month, if
+        # that's sooner) gives a lower bound.
+        t_left = max(self._get_time_left(time) - T_ELAPSED_DEFAULT, 0)
+        t_next = time + timedelta(
+            seconds=self._get_minimum_interval(t_left, rem)
+        )
+        # The sentinel is only a shortcut; if it can't be written, the
+        # interval check falls back to the latest stored entry.
+        try:
+            os.makedirs(os.path.dirname(self.path_next), exist_ok=True)
+            with open(self.path_next, 'a'):
+                pass
+            os.utime(self.path_next, (t_next.timestamp(),) * 2)
+        except OSError:
+            pass
+
+    def _get_last_plotted(self):
+        # Timestamp of the latest quota in the figure, if recorded.
+        try:
+            with open(self.path_plotted) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _set_last_plotted(self, tstamp):
+        # Only used to skip redundant redraws, so failing to record it
+        # just means the next update redraws.
+        try:
+            with open(self.path_plotted, 'w') as f:
+                f.write(tstamp)
+        except OSError:
+            pass
 
     # TODO: Change name to the less verbose 'can_update'
     def _sufficient_fetch_interval(self):
         # Be polite: we only need to check at most every hour, and for
         # most of the month, less than that.
+        now = self._get_time_now()
+
+        # Runs before the next fetch could be due are turned away
+        # without touching the database.
+        try:
+            if now.timestamp() < os.stat(self.path_next).st_mtime:
+                return False
+        except OSError:
+            pass
 
         # Get basic stats from the last update and the current time.
-        now = datetime.now()
         time, rem = self._get_latest()
 
         # Evaluate whether we have crossed the relevant thresholds
@@ -130,10 +205,28 @@ class Main(object):
         return t_elapsed >  self._get_minimum_interval(t_left, rem)
 
 
-if __name__ == '__main__':
+def _parse_update_args(argv):
+    """Parse `update [--user USER] [--pass PASS]` without argparse.
 
-    # Start by instantiating the main class so we can bind its methods
-    main = Main()
+    This is the form invoked by cron, so it's handled directly to
+    avoid importing argparse and building the full parser. Returns
+    None for anything else (other subcommands, help, --opt=value
+    forms, etc.), which is left to `_build_parser`.
+    """
+    if not argv or argv[0] != 'update' or len(argv) % 2 == 0:
+        return None
+    opts = {'--user': None, '--pass': None}
+    for flag, value in zip(argv[1::2], argv[2::2]):
+        if flag not in opts or value.startswith('-'):
+            return None
+        opts[flag] = value
+    return SimpleNamespace(user=opts['--user'], passwd=opts['--pass'])
+
+
+def _build_parser(main):
+    # Build the full command-line parser, binding subcommands to the
+    # methods of `main`.
+    import argparse
 
     # Top level parser (main, named after this module)
     parser = argparse.ArgumentParser(prog='main')
@@ -164,22 +257,33 @@ if __name__ == '__main__':
         'plot',
         description="Plot data in local store for this month."
     )
-    parser_plot.add_argument(
-        '--month',
-        dest='month',
-        type=str,
-        default=datetime.today().strftime('%Y-%m')
-    )
+    parser_plot.add_argument('--month', dest='month', type=str,
+                             default=None)
     parser_plot.add_argument('--file', dest='file', type=str,
                              default=None)
     parser_plot.set_defaults(func=main.plot)
 
+    return parser
+
+
+if __name__ == '__main__':
+
+    # Start by instantiating the main class so we can bind its methods
+    main = Main()
+
     # Parse the command-line arguments and invoke the relevant bound
     # method/function with the arguments object (selects appropriate
-    # subparser; yes, this is a bit obtuse).
-    args = parser.parse_args()
+    # subparser; yes, this is a bit obtuse). The common update case
+    # skips argparse.
+    args = _parse_update_args(sys.argv[1:])
+    if args is not None:
+        args.func = main.update
+    else:
+        args = _build_parser(main).parse_args()
     try:
         args.func(args)
     except AttributeError as err:
         if str(err) == "'Namespace' object has no attribute 'func'":
             raise RuntimeError("Missing subcommand.")
+    finally:
+        store.close_connection()
@@ -1,12 +1,12 @@
 -- Schema description.
 CREATE TABLE quota_history(
-	timestamp TEXT,
+	timestamp INTEGER,
 	remaining INT,
 	PRIMARY KEY(timestamp)
 );
 
 CREATE TABLE quota_monthly(
-	month_start TEXT,
+	month_start INTEGER,
 	quota INT,
 	PRIMARY KEY(month_start)
 );
@@ -1,8 +1,9 @@
 -- The quota_history table contains remaining quota at the specified
 -- times, this needs to be xref'd with quota_monthly to get the total
--- quota for that period.
+-- quota for that period. Timestamps are unix epoch seconds (local
+-- times are stored as if UTC).
 CREATE TABLE quota_history(
-	timestamp TEXT,
+	timestamp INTEGER,
 	remaining INT,
 	PRIMARY KEY(timestamp)
 );
@@ -1,8 +1,9 @@
 -- quota_monthly contains the total monthly quota aligned to the start
 -- of the month; aa align it like this and quota is fixed for the
--- current month.
+-- current month. month_start is unix epoch seconds, as with
+-- quota_history.timestamp.
 CREATE TABLE quota_monthly(
-	month_start TEXT,
+	month_start INTEGER,
 	quota INT,
 	PRIMARY KEY(month_start)
 );
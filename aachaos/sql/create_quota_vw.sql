@@ -10,7 +10,10 @@ FROM
 	quota_history qh
 	INNER JOIN 
 	quota_monthly qm
-	ON datetime(qm.month_start) = datetime(qh.timestamp, 'start of month')
+	ON qm.month_start = CAST(
+		strftime('%s', qh.timestamp, 'unixepoch', 'start of month')
+		AS INTEGER
+	)
 ORDER BY
 	timestamp DESC
 ;
@@ -0,0 +1,17 @@
+-- Convert a database created with TEXT ('YYYY-MM-DD HH:MM') timestamps
+-- to INTEGER unix epoch seconds. The old tables are renamed and copied
+-- into freshly created ones (the create*.sql statements are inserted
+-- in place of the marker below), then the view is recreated.
+DROP VIEW quota_vw;
+ALTER TABLE quota_history RENAME TO quota_history_text;
+ALTER TABLE quota_monthly RENAME TO quota_monthly_text;
+-- {create tables}
+INSERT INTO quota_history
+SELECT CAST(strftime('%s', timestamp) AS INTEGER), remaining
+FROM quota_history_text;
+INSERT INTO quota_monthly
+SELECT CAST(strftime('%s', month_start) AS INTEGER), quota
+FROM quota_monthly_text;
+DROP TABLE quota_history_text;
+DROP TABLE quota_monthly_text;
+-- {create views}
@@ -3,7 +3,10 @@
 import os
 import glob
 import sqlite3
-from datetime import datetime
+import weakref
+import threading
+import contextlib
+from datetime import datetime, timezone
 
 from aachaos.config import settings
 
@@ -13,16 +16,60 @@ PATH_SQL = os.path.join(os.path.dirname(__file__), 'sql')
 PATH_DB = settings.get('Path', 'Database')
 
 
+def _read_sql(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _read_schema():
+    # Concatenate the CREATE statements from source into scripts for
+    # the tables and the views (which depend on the tables).
+    file_list = sorted(glob.glob(os.path.join(PATH_SQL, 'create*.sql')))
+    tables = [_read_sql(p) for p in file_list if 'vw' not in p]
+    views = [_read_sql(p) for p in file_list if 'vw' in p]
+    return '\n'.join(tables), '\n'.join(views)
+
+
+def _script(*statements):
+    # Wrap statements in a single transaction for `executescript`.
+    return '\n'.join(('BEGIN;',) + statements + ('COMMIT;',))
+
+
+_SQL_TABLES, _SQL_VIEWS = _read_schema()
+SQL_SCHEMA = _script(_SQL_TABLES, _SQL_VIEWS)
+SQL_MIGRATE = _script(
+    _read_sql(os.path.join(PATH_SQL, 'migrate_text_timestamps.sql'))
+    .replace('-- {create tables}', _SQL_TABLES)
+    .replace('-- {create views}', _SQL_VIEWS)
+)
+SQL_INSERT_HISTORY = "INSERT OR IGNORE INTO quota_history VALUES (?, ?)"
+SQL_INSERT_MONTHLY = "INSERT OR IGNORE INTO quota_monthly VALUES (?, ?)"
+
+
 class DB(sqlite3.Connection):
 
     path_db = PATH_DB
-    dtfmt = '%Y-%m-%d %H:%M'
 
-    def __init__(self):
+    # Connection pragmas, applied on every open. WAL stops readers
+    # (e.g. the webapp) blocking the cron-time writer and vice versa.
+    # Set any of these to None to leave the SQLite default in place.
+    journal_mode = 'WAL'
+    synchronous = 'NORMAL'
+    temp_store = 'MEMORY'
+    mmap_size = 268435456   # bytes
+    cache_size = -8000      # KiB (negative) or pages (positive)
+
+    # Objects with an `invalidate()` method, notified whenever quota
+    # data is committed (e.g. `get.History` caches).
+    observers = weakref.WeakSet()
+
+    def __init__(self, path=None):
         # Connection is created on initialisation. If the database
         # file isn't present already, create the directory structure
-        # and before initialising, then create the schema.
-        fpath = self.path_db
+        # and before initialising, then create the schema. The path
+        # defaults to the configured database.
+        fpath = self.path_db = self.path_db if path is None else path
+        self._in_batch = False
         if not os.path.isfile(fpath):
             if fpath != ':memory:':
                 # mkdir -p
@@ -31,57 +78,137 @@ class DB(sqlite3.Connection):
             self.create()
         else:
             super().__init__(fpath)
+            self._migrate()
+        self._apply_pragmas()
 
-    def __exit__(self, type, value, traceback):
-        # sqlite3.Connection isn't closed on exit.
-        self.commit()
-        self.close()
+    def _apply_pragmas(self):
+        # Issued as a single script; executescript commits any pending
+        # transaction first, which journal_mode requires anyway.
+        pragmas = ['journal_mode', 'synchronous', 'temp_store',
+                   'cache_size']
+        # Memory-mapping an empty file is wasted address space.
+        fpath = self.path_db
+        if fpath != ':memory:' and os.path.getsize(fpath) > 0:
+            pragmas.append('mmap_size')
+
+        script = ''.join(
+            "PRAGMA {}={};".format(name, getattr(self, name))
+            for name in pragmas
+            if getattr(self, name) is not None
+        )
+        self.executescript(script)
+
+    def _migrate(self):
+        # Convert databases created when timestamps were stored as
+        # TEXT to the current (INTEGER) schema.
+        cursor = self.execute(
+            """
+            SELECT type
+            FROM pragma_table_info('quota_history')
+            WHERE name = 'timestamp'
+            """
+        )
+        coltype = cursor.fetchone()
+        if coltype is not None and coltype[0] == 'TEXT':
+            self.executescript(SQL_MIGRATE)
 
     def create(self):
         """Create database schema."""
-        # Fetch the CREATE TABLE statements from source and execute
-        # them via the db connection.
-        file_list = sorted(
-            glob.glob(os.path.join(PATH_SQL, 'create*.sql')),
-            key=lambda sql: 1 if 'vw' in sql else 0
-        )
+        # The statements are run as one script in a single transaction
+        # so a failure can't leave a partial schema behind.
+        self.executescript(SQL_SCHEMA)
 
-        for path in file_list:
-            with open(path, 'r') as f:
-                sql = f.read()
-            self.execute(sql)
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Commit on success, roll back on error. Within a transaction
+        # the caller already holds, use a savepoint instead and leave
+        # committing to the caller. Observers are notified once data
+        # is committed, and on any rollback (data they've read since
+        # may have been discarded).
+        nested = self.in_transaction
+        if nested:
+            self.execute("SAVEPOINT quota")
+        try:
+            yield
+        except:
+            if nested:
+                self.execute("ROLLBACK TO quota")
+                self.execute("RELEASE quota")
+            else:
+                self.rollback()
+            self._invalidate()
+            raise
+        else:
+            if nested:
+                self.execute("RELEASE quota")
+            else:
+                self.commit()
+                self._invalidate()
+
+    def _invalidate(self):
+        # Notify observers that the data may have changed.
+        for observer in list(self.observers):
+            observer.invalidate()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group inserts in the block into a single transaction.
+
+        Inserts within the block aren't committed individually; the
+        lot is committed at the end of the block (or rolled back on
+        error). Use `flush` to commit part-way through. A batch can't
+        be started within an open transaction.
+        """
+        if self.in_transaction:
+            raise sqlite3.ProgrammingError(
+                "Can't start a batch within an open transaction."
+            )
+        self._in_batch = True
+        try:
+            with self._transaction():
+                self.execute("BEGIN")
+                yield self
+        finally:
+            self._in_batch = False
+
+    def flush(self):
+        """Commit pending changes, keeping any open batch going."""
         self.commit()
+        self._invalidate()
+        if self._in_batch:
+            self.execute("BEGIN")
 
     def insert_quota(self, pydt, remaining, total):
         """Store usage/quota at a given time."""
-        self.execute("BEGIN TRANSACTION")
-        try:
+        with self._transaction():
             self._insert_quota_history(pydt, remaining)
             self._insert_quota_monthly(pydt, total)
-        except:
-            self.rollback()
-            raise
+
+    def insert_quota_many(self, quotas):
+        """Store an iterable of (pydt, remaining, total) records.
+
+        All records are inserted in a single transaction, in timestamp
+        order so the index is appended to sequentially.
+        """
+        history, monthly = [], {}
+        for pydt, remaining, total in sorted(quotas, key=lambda q: q[0]):
+            month_start = datetime(pydt.year, pydt.month, 1)
+            history.append((self.pydt_to_dbdt(pydt), remaining))
+            # As with `insert_quota`, the first total for a month wins.
+            monthly.setdefault(self.pydt_to_dbdt(month_start), total)
+
+        with self._transaction():
+            self.executemany(SQL_INSERT_HISTORY, history)
+            self.executemany(SQL_INSERT_MONTHLY, monthly.items())
 
     def _insert_quota_history(self, pydt, remaining):
         dbdt = self.pydt_to_dbdt(pydt)
-        self.execute(
-            """
-            INSERT OR IGNORE INTO quota_history
-            VALUES (?, ?)
-            """,
-            (dbdt, remaining)
-        )
+        self.execute(SQL_INSERT_HISTORY, (dbdt, remaining))
 
     def _insert_quota_monthly(self, pydt, total):
         month_start = datetime(pydt.year, pydt.month, 1)
         dbdt = self.pydt_to_dbdt(month_start)
-        self.execute(
-            """
-            INSERT OR IGNORE INTO quota_monthly
-            VALUES (?, ?)
-            """,
-            (dbdt, total)
-        )
+        self.execute(SQL_INSERT_MONTHLY, (dbdt, total))
 
     # WIP
     #def dump(self, fpath):
@@ -103,18 +230,57 @@ class DB(sqlite3.Connection):
             ORDER BY name
             """
         )
-        return tuple(
-            table
-            for tup in cursor.fetchall()
-            for table in tup
+        cursor.row_factory = lambda cursor, row: row[0]
+        return tuple(cursor)
+
+    @staticmethod
+    def pydt_to_dbdt(pydt):
+        """Convert a py datetime obj. to an SQLite INTEGER timestamp.
+
+        Timestamps are unix epoch seconds truncated to the minute;
+        naive (local) datetimes are stored as if they were UTC so
+        SQLite's date functions give the same calendar fields back.
+        """
+        pydt = pydt.replace(second=0, microsecond=0)
+        if pydt.tzinfo is None:
+            pydt = pydt.replace(tzinfo=timezone.utc)
+        return int(pydt.timestamp())
+
+    @staticmethod
+    def dbdt_to_pydt(dbdt):
+        """Convert an SQLite INTEGER timestamp to a py datetime obj."""
+        return datetime.fromtimestamp(dbdt, timezone.utc).replace(
+            tzinfo=None
         )
 
-    @classmethod
-    def pydt_to_dbdt(cls, pydt):
-        """Convert a py datetime obj. to a SQLite-friendly string."""
-        return pydt.strftime(cls.dtfmt)
 
-    @classmethod
-    def dbdt_to_pydt(cls, dbdt):
-        """Convert a SQLite datetime string to a py datetime obj."""
-        return datetime.strptime(dbdt, cls.dtfmt)
+# Connections are shared per (thread, DB class) so the page cache and
+# pragma setup survive between queries; sqlite3 connections can't be
+# used across threads by default.
+_local = threading.local()
+
+
+def get_connection(cls=None, path=None):
+    """Return the shared connection for a `DB` (sub)class and path.
+
+    The connection is opened on first use and reused thereafter; use
+    `close_connection` on shutdown rather than closing it directly.
+    """
+    cls = DB if cls is None else cls
+    key = (cls, cls.path_db if path is None else path)
+    connections = _local.__dict__.setdefault('connections', {})
+    if key not in connections:
+        connections[key] = cls(key[1])
+    return connections[key]
+
+
+def close_connection(cls=None):
+    """Close the shared connection(s) opened by `get_connection`.
+
+    Closes the connections for `cls` only, if specified, otherwise all
+    shared connections in the current thread.
+    """
+    connections = _local.__dict__.get('connections', {})
+    for key in list(connections):
+        if cls is None or key[0] is cls:
+            connections.pop(key).close()
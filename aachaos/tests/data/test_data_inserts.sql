@@ -1,6 +1,6 @@
-INSERT INTO "quota_monthly" VALUES('2000-01-01 00:00',100000000000);
-INSERT INTO "quota_monthly" VALUES('2000-02-01 00:00',100000000000);
-INSERT INTO "quota_history" VALUES('2000-01-01 18:00',98123456789);
-INSERT INTO "quota_history" VALUES('2000-01-02 00:00',96987654321);
-INSERT INTO "quota_history" VALUES('2000-02-01 01:00',99999999900);
+INSERT INTO "quota_monthly" VALUES(946684800,100000000000);
+INSERT INTO "quota_monthly" VALUES(949363200,100000000000);
+INSERT INTO "quota_history" VALUES(946749600,98123456789);
+INSERT INTO "quota_history" VALUES(946771200,96987654321);
+INSERT INTO "quota_history" VALUES(949366800,99999999900);
 COMMIT;
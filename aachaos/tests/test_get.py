@@ -1,17 +1,20 @@
 """Module containing unit tests relating to fetching data."""
 
 import unittest
+import io
 import os
 import sqlite3
 import tempfile
 from datetime import datetime
 from collections import namedtuple
 
-from unittest.mock import patch
+from unittest.mock import patch, Mock, MagicMock
 from ddt import data, unpack, ddt as DDT
 import pandas
+import requests
 
-from aachaos.get import LineInfo, Quota, DB, History
+import aachaos.get
+from aachaos.get import LineInfo, Quota, DB, History, Credentials
 
 PATHD_TEST = os.path.dirname(__file__)
 PATHD_TESTDATA = os.path.join(PATHD_TEST, 'data')
@@ -21,6 +24,20 @@ PATH_MINRESPONSE = os.path.join(
 )
 PATH_TESTDB = os.path.join(PATHD_TESTDATA, 'test_store.db')
 
+
+def load_testdb(cls=DB):
+    """Return an in-memory copy of the reference database."""
+    db = cls(':memory:')
+    db.execute("ATTACH DATABASE ? AS ref", (PATH_TESTDB,))
+    with db:
+        for table in db.tables():
+            db.execute(
+                "INSERT INTO {0} SELECT * FROM ref.{0}".format(table)
+            )
+    db.execute("DETACH DATABASE ref")
+    return db
+
+
 class TestLineInfo(unittest.TestCase):
     """Check the functionality of the LineInfo class.
 
@@ -32,21 +49,74 @@ class TestLineInfo(unittest.TestCase):
     @patch('aachaos.get.LineInfo.parse')
     @patch('aachaos.get.LineInfo.fetch')
     def test___init__(self, mock_fetch, mock_parse):
-        mock_fetch.return_value = self.xml_minimal_response
         line_info = LineInfo('any user', 'any pass')
 
         #import pdb; pdb.set_trace()
         mock_fetch.assert_called_with('any user', 'any pass')
-        mock_parse.assert_called_with(mock_fetch.return_value)
+        mock_parse.assert_called_with(mock_fetch.return_value.raw)
+        mock_fetch.return_value.__exit__.assert_called_once()
+
+
+    @patch('aachaos.get._SESSION.get')
+    def test_fetch(self, mock_get):
+        """Fetch requests line info via the shared session."""
+        mock_get.return_value.raw = io.BytesIO(self.xml_minimal_response)
+        line_info = LineInfo('any user', 'any pass')
+
+        mock_get.assert_called_once_with(
+            'https://chaos.aa.net.uk/info',
+            auth=('any user', 'any pass'),
+            stream=True,
+            timeout=aachaos.get.HTTP_TIMEOUT
+        )
+        self.assertEqual(line_info.quota.rem, 3394211557)
+
+    @patch('aachaos.get._SESSION.get')
+    def test_fetch_error(self, mock_get):
+        """An error status is raised (and the response closed)."""
+        mock_get.return_value.raise_for_status.side_effect = (
+            requests.HTTPError
+        )
+        self.assertRaises(requests.HTTPError,
+                          LineInfo, 'any user', 'any pass')
+        mock_get.return_value.close.assert_called_once_with()
+
+    @patch('aachaos.get._SESSION')
+    def test_set_session(self, mock_default):
+        """An injected session is used in place of the default."""
+        session = MagicMock()
+        session.get.return_value.raw = io.BytesIO(
+            self.xml_minimal_response
+        )
+        aachaos.get.set_session(session)
+        LineInfo('any user', 'any pass')
+
+        session.get.assert_called_once()
+        mock_default.get.assert_not_called()
 
     @patch('aachaos.get.LineInfo.fetch')
     def test_parse(self, mock_fetch):
         """Parse creates a Quota object at `_quota` as a side-effect.
         """
-        mock_fetch.return_value = self.xml_minimal_response
+        mock_fetch.return_value.raw = self.xml_minimal_response
         line_info = LineInfo('any user', 'any pass')
         self.assertIsInstance(line_info._quota, Quota)
         self.assertEqual(line_info._quota.rem, 3394211557)
+        self.assertEqual(line_info._quota.tstamp,
+                         datetime(2000, 5, 20, 11))
+
+    @patch('aachaos.get.LineInfo.fetch')
+    def test_parse_error(self, mock_fetch):
+        """An error response raises an AuthenticationError.
+
+        The response is closed regardless.
+        """
+        mock_fetch.return_value.raw = io.BytesIO(
+            b'<chaos xmlns="https://chaos.aa.net.uk/" error="Bad login"/>'
+        )
+        self.assertRaises(LineInfo.AuthenticationError,
+                          LineInfo, 'any user', 'any pass')
+        mock_fetch.return_value.__exit__.assert_called_once()
 
 
 class TestDB(unittest.TestCase):
@@ -59,13 +129,15 @@ class TestDB(unittest.TestCase):
     etc.
     """
 
-    # TODO: Use mock for this!
-    # TODO: Move to memory?
-    DB.path_db = PATH_TESTDB
+    @classmethod
+    def setUpClass(cls):
+        # The tests only read, so share one in-memory copy of the
+        # reference database.
+        cls.db = load_testdb()
 
-    def setUp(self):
-        # Create a connection to the reference database.
-        self.db = DB()
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
 
     def test_select_from_quota_vw(self):
         """Returns contents of `quota_vw` as a DataFrame."""
@@ -73,6 +145,37 @@ class TestDB(unittest.TestCase):
         self.assertIsInstance(df, pandas.DataFrame)
         self.assertEqual(len(df), 68)
 
+    def test_select_from_quota_vw_cached(self):
+        """The DataFrame is re-read only once the data changes."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'store.db')
+            db, other = DB(path), DB(path)
+            df = db.select_from_quota_vw()
+            self.assertIs(db.select_from_quota_vw(), df)
+
+            # Changes through this connection...
+            db.insert_quota(datetime(2000, 1, 1, 18), 98, 100)
+            df = db.select_from_quota_vw()
+            self.assertEqual(len(df), 1)
+            self.assertIs(db.select_from_quota_vw(), df)
+
+            # ...and through another.
+            other.insert_quota(datetime(2000, 1, 1, 19), 97, 100)
+            self.assertEqual(len(db.select_from_quota_vw()), 2)
+            db.close()
+            other.close()
+
+    def test_select_from_quota_vw_rollback(self):
+        """Rows read within a rolled back batch aren't served again."""
+        db = DB(':memory:')
+        with self.assertRaises(RuntimeError):
+            with db.batch():
+                db.insert_quota(datetime(2000, 1, 1, 18), 98, 100)
+                self.assertEqual(len(db.select_from_quota_vw()), 1)
+                raise RuntimeError
+        self.assertEqual(len(db.select_from_quota_vw()), 0)
+        db.close()
+
     def test_select_last_from_quota_vw(self):
         """Return the latest timestamp and percent value."""
         t = self.db.select_last_from_quota_vw()
@@ -82,6 +185,74 @@ class TestDB(unittest.TestCase):
         self.assertEqual(t[1], 98)
 
 
+class TestCredentials(unittest.TestCase):
+    """Exercise retrieval of stored credentials."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.auth_path = os.path.join(self.tmpdir.name, 'auth')
+        self.write_auth('a user:a pass')
+        patcher = patch.object(Credentials, 'auth_path', self.auth_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        Credentials._cache.clear()
+        self.tmpdir.cleanup()
+
+    def write_auth(self, userpasswd, mtime_ns=None):
+        with open(self.auth_path, 'w') as f:
+            f.write(userpasswd + '\n')
+        os.chmod(self.auth_path, 0o600)
+        if mtime_ns is not None:
+            os.utime(self.auth_path, ns=(mtime_ns, mtime_ns))
+
+    def test_retrieve(self):
+        """Credentials are read from the auth file."""
+        credentials = Credentials()
+        self.assertEqual(credentials.user, 'a user')
+        self.assertEqual(credentials.passwd, 'a pass')
+
+    def test_retrieve_colon(self):
+        """Only the first colon separates the user and password."""
+        self.write_auth('a user:a:pass')
+        credentials = Credentials()
+        self.assertEqual(credentials.passwd, 'a:pass')
+
+    def test_retrieve_missing(self):
+        """A missing auth file is reported as such."""
+        os.remove(self.auth_path)
+        self.assertRaises(Credentials.FileNotPresent, Credentials)
+
+    def test_retrieve_insecure(self):
+        """An auth file readable by others is rejected."""
+        os.chmod(self.auth_path, 0o644)
+        self.assertRaises(Credentials.FileNotSecure, Credentials)
+
+    @unittest.skipIf(os.geteuid() == 0, "root can read any file")
+    def test_retrieve_unreadable(self):
+        """An auth file that can't be read is rejected."""
+        os.chmod(self.auth_path, 0o200)
+        self.assertRaises(Credentials.FileNotSecure, Credentials)
+
+    def test_retrieve_fifo(self):
+        """A non-regular auth file is rejected without blocking."""
+        os.remove(self.auth_path)
+        os.mkfifo(self.auth_path, 0o600)
+        self.assertRaises(Credentials.FileNotPresent, Credentials)
+
+    def test_retrieve_cached(self):
+        """The auth file is only re-read once it's modified."""
+        Credentials()
+        with patch('aachaos.get.os.read', side_effect=AssertionError):
+            credentials = Credentials()
+        self.assertEqual(credentials.user, 'a user')
+
+        self.write_auth('new user:new pass', mtime_ns=1)
+        credentials = Credentials()
+        self.assertEqual(credentials.user, 'new user')
+
+
 @patch('aachaos.get.DB.select_from_quota_vw')
 class TestHistory(unittest.TestCase):
     """Exercise the History data-retrieval class.
@@ -120,23 +291,56 @@ class TestHistory(unittest.TestCase):
         )
     )
 
+    def setUp(self):
+        self.db = DB(':memory:')
+        self.history = History(self.db)
+
+    def tearDown(self):
+        DB.observers.discard(self.history)
+        self.db.close()
+
     # ----------------------------------------------------------------
     # Test Properties
     # ----------------------------------------------------------------
     def test_quota(self, mock_select_from_quota_vw):
         """Quota is a monthly quota value."""
         mock_select_from_quota_vw.return_value = self.df_quota_vw
-        history = History()
+        history = self.history
         quota = history.quota(units='B')
         self.assertIsInstance(quota, pandas.Series)
+        pandas.testing.assert_series_equal(history.quota(),
+                                           self.ts_quota.astype(float),
+                                           check_names=False)
 
     def test_usage(self, mock_select_from_quota_vw):
         """Quota returns a time-series of quota remainder."""
         mock_select_from_quota_vw.return_value = self.df_quota_vw
-        history = History()
+        history = self.history
         usage = history.usage(units='B')
         self.assertIsInstance(usage, pandas.Series)
 
+    def test_by_month(self, mock_select_from_quota_vw):
+        """Usage is filtered to the specified month."""
+        mock_select_from_quota_vw.return_value = self.df_quota_vw
+        history = self.history
+        usage = history.by_month('2000-01', units='B')
+        pandas.testing.assert_series_equal(usage,
+                                           self.ts_usage[:2],
+                                           check_names=False,
+                                           check_freq=False)
+
+    def test_invalidate(self, mock_select_from_quota_vw):
+        """The view is queried once until the cache is invalidated."""
+        mock_select_from_quota_vw.return_value = self.df_quota_vw
+        history = self.history
+        history.usage()
+        history.usage(units='B')
+        self.assertEqual(mock_select_from_quota_vw.call_count, 1)
+
+        history.invalidate()
+        history.usage()
+        self.assertEqual(mock_select_from_quota_vw.call_count, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
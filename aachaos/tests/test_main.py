@@ -4,14 +4,17 @@ import unittest
 from unittest.mock import patch
 from datetime import datetime, timedelta
 from collections import namedtuple
+from types import SimpleNamespace
 import contextlib
 import io
+import os
+import tempfile
 
 from ddt import ddt as DDT, data, unpack
 
 import aachaos.main
 import aachaos.get
-from aachaos.tests.test_get import PATH_TESTDB
+from aachaos.tests.test_get import load_testdb
 
 
 @DDT
@@ -25,20 +28,35 @@ class TestMain(unittest.TestCase):
 
     def setUp(self):
         self.main = aachaos.main.Main()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.main.path_next = os.path.join(self.tmpdir.name, 'next')
+        self.main.path_plotted = os.path.join(self.tmpdir.name,
+                                              'plotted')
 
     def tearDown(self):
-        pass
+        aachaos.main._latest = None
+        self.tmpdir.cleanup()
 
-    @patch('aachaos.main.vis.Plotter.plot_month')
+    @data(
+        (False, None, True),
+        (True, None, True),
+        (True, 0, False),
+        (True, -3600, True),
+        (False, 0, True)
+    )
+    @unpack
+    @patch('aachaos.vis.Plotter.plot_month')
     @patch('aachaos.main.Main._sufficient_fetch_interval')
     @patch('aachaos.main.Main._get_quota')
-    @patch('aachaos.main.store.DB.insert_quota')
-    def test_update(self, mock_insert, mock_call, mock_check,
-                    mock_plot):
+    @patch('aachaos.main.store.get_connection')
+    def test_update(self, fig_exists, last_plotted, plotted, mock_conn,
+                    mock_call, mock_check, mock_plot):
         """Check an update is fetched from the API and stored.
 
         Additionally, a side-effect is to generate a plot during this
-        procedure.
+        procedure, unless the figure exists and was last drawn from
+        the same quota (`last_plotted` seconds relative to it, or not
+        recorded if None).
         """
         # Database, API and interval check are mocked.
         #
@@ -46,38 +64,59 @@ class TestMain(unittest.TestCase):
         #     return a sample `get.Quota` instance from
         #     `Main._get_quota()`
         #   - We don't actually care about writing to a database here,
-        #     so just check the `store.DB.insert_quota` method is
-        #     called correctly.
+        #     so just check the `insert_quota` method of the shared
+        #     connection is called correctly.
         #	- We don't want to actually check for the latest fetch so
         #     avoid this entirely by mocking the interval check.
         #   - We don't want to actually plot anything.
+        #
+        # The figure is always newer than the quota, so whether it's
+        # redrawn doesn't depend on when it was written.
         quota = aachaos.get.Quota(
-            datetime.today(),
+            datetime.today() - timedelta(hours=1),
             12345678987,
             100000000000
         )
+        tstamp = quota.tstamp.replace(second=0, microsecond=0)
         mock_call.return_value = quota
         mock_check.return_value = True
+        self.main.path_fig = os.path.join(self.tmpdir.name, 'fig.svg')
+        if fig_exists:
+            open(self.main.path_fig, 'w').close()
+        if last_plotted is not None:
+            t_plotted = tstamp + timedelta(seconds=last_plotted)
+            self.main._set_last_plotted(t_plotted.isoformat())
 
         args = namedtuple('Args', 'user, passwd')('a user', 'a pass')
         self.main.update(args)
-        mock_insert.assert_called_with(*quota)
-        mock_plot.assert_called_with(
-            datetime.today().strftime('%Y-%m'),
-            self.main.path_fig
+        mock_conn.assert_called_with(aachaos.get.DB)
+        mock_conn.return_value.insert_quota.assert_called_with(*quota)
+        self.assertEqual(
+            self.main._get_latest(),
+            (quota.tstamp.replace(second=0, microsecond=0), 12.345678987)
         )
+        if plotted:
+            mock_plot.assert_called_with(
+                datetime.today().strftime('%Y-%m'),
+                self.main.path_fig
+            )
+        else:
+            mock_plot.assert_not_called()
+        self.assertEqual(self.main._get_last_plotted(), tstamp.isoformat())
 
     def test_data(self):
         """Check data is returned to the shell.
 
         This function spits out the contents of the `quota_view`
-        table. The `get.DB` method that returns this is mocked to
-        return a constant sample. The data is a pandas dataframe, so
-        this test is configured to reflect this.
+        table. The shared connection is mocked to be one to the
+        reference database. The data is a pandas dataframe, so this
+        test is configured to reflect this.
         """
-        aachaos.main.get.DB.db_path = PATH_TESTDB
+        db = load_testdb()
         out = io.StringIO()
-        with contextlib.redirect_stdout(out):
+        with contextlib.redirect_stdout(out), \
+             patch('aachaos.main.store.get_connection',
+                   return_value=db):
             # NOTE: Cannot use pdb in this context.
             self.main.data()
             last_row = out.getvalue().splitlines()[-3]
@@ -86,9 +125,30 @@ class TestMain(unittest.TestCase):
         # currently:
         self.assertIn('2002-01-01 18:00:00', last_row)
 
+    @data((None, '2000-02'), ('2000-01', '2000-01'))
+    @unpack
+    @patch('aachaos.vis.Plotter.plot_month')
+    @patch('aachaos.main.Main._get_time_now')
+    def test_plot(self, month, expected, mock_now, mock_plot):
+        """Check the month plotted defaults to the current month."""
+        mock_now.return_value = datetime(2000, 2, 15)
+        args = SimpleNamespace(month=month, file=None)
+        self.main.plot(args)
+        mock_plot.assert_called_once_with(month=expected, fpath=None)
+
     # ----------------------------------------------------------------
     # Internal methods
     # ----------------------------------------------------------------
+    @patch('aachaos.main.store.get_connection')
+    def test__get_latest(self, mock_conn):
+        """Check the latest entry is only queried once."""
+        latest = (datetime(2000, 1, 1, 18), 98.0)
+        mock_select = mock_conn.return_value.select_last_from_quota_vw
+        mock_select.return_value = latest
+        self.assertEqual(self.main._get_latest(), latest)
+        self.assertEqual(self.main._get_latest(), latest)
+        mock_select.assert_called_once_with()
+
     # _get_quota is not tested, this is a simple wrapper around
     # `get.Lineinfo`.
     @data(
@@ -109,6 +169,82 @@ class TestMain(unittest.TestCase):
         func = main._get_minimum_interval
         self.assertEqual(func(days*24*3600, pc), interval*3600)
 
+    @data(
+        ((2000, 1, 15, 12), 50.0, (2000, 1, 15, 15)),
+        ((2000, 1, 15, 12), 7.5, (2000, 1, 15, 14)),
+        ((2000, 1, 30, 12), 50.0, (2000, 1, 30, 14)),
+        ((2000, 1, 31, 22), 50.0, (2000, 1, 31, 23)),
+    )
+    @unpack
+    def test__set_next_fetch(self, time, rem, t_next):
+        """Check the next fetch is not held back past its due time.
+
+        Updates are turned away until then without querying the
+        latest entry.
+        """
+        self.main._set_next_fetch(datetime(*time), rem)
+        t_next = datetime(*t_next)
+        self.assertEqual(os.stat(self.main.path_next).st_mtime,
+                         t_next.timestamp())
+
+        with patch.object(self.main, '_get_time_now',
+                          return_value=t_next - timedelta(minutes=1)), \
+             patch.object(self.main, '_get_latest',
+                          side_effect=AssertionError):
+            self.assertFalse(self.main._sufficient_fetch_interval())
+
+    def test__set_next_fetch_error(self):
+        """An inaccessible sentinel is ignored; the DB is checked instead."""
+        time = datetime(2000, 1, 15, 12)
+        with patch('aachaos.main.os.utime', side_effect=PermissionError):
+            self.main._set_next_fetch(time, 50)
+
+        with patch('aachaos.main.os.stat', side_effect=PermissionError), \
+             patch.object(self.main, '_get_time_now', return_value=time), \
+             patch.object(self.main, '_get_latest',
+                          return_value=(time, 50)) as mock_latest:
+            self.main._sufficient_fetch_interval()
+        mock_latest.assert_called_once_with()
+
+    @data(
+        ((2000, 1, 15, 12), 16.5),
+        ((2000, 2, 1), 29),
+        ((2000, 12, 31, 18), 0.25)
+    )
+    @unpack
+    def test__get_time_left(self, now, days):
+        """Check the time left until the end of the month.
+
+        Time is measured in seconds.
+        """
+        func = self.main._get_time_left
+        self.assertEqual(func(datetime(*now)), days*24*3600)
+
+
+@DDT
+class TestParseUpdateArgs(unittest.TestCase):
+    """Check the argparse-free parsing of the `update` subcommand."""
+
+    @data(
+        (['update'], None, None),
+        (['update', '--user', 'a user'], 'a user', None),
+        (['update', '--pass', 'a pass', '--user', 'a user'],
+         'a user', 'a pass'),
+    )
+    @unpack
+    def test_parsed(self, argv, user, passwd):
+        args = aachaos.main._parse_update_args(argv)
+        self.assertEqual((args.user, args.passwd), (user, passwd))
+
+    @data(
+        [], ['data'], ['plot', '--month', '2000-01'], ['update', '-h'],
+        ['update', '--user'], ['update', '--user=a user'],
+        ['update', '--user', '--pass'], ['update', '--other', 'x'],
+    )
+    def test_deferred(self, argv):
+        """Anything else is left to argparse."""
+        self.assertIsNone(aachaos.main._parse_update_args(argv))
+
 
 if __name__ == '__main__':
     unittest.main()
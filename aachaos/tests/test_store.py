@@ -2,14 +2,17 @@
 
 import unittest
 import os
+import shutil
 import sqlite3
 import tempfile
 from datetime import datetime
 from collections import namedtuple
+from unittest.mock import patch, Mock
 
 from ddt import data, unpack, ddt as DDT
 
-from aachaos.store import DB
+from aachaos.store import DB, get_connection, close_connection
+from aachaos.tests.test_get import load_testdb
 
 
 @DDT
@@ -29,17 +32,28 @@ class TestDB(unittest.TestCase):
         'test_store.db'
     )
 
-    # TODO: Use mock for this!
-    # TODO: Move to memory?
-    DB.path_db = path_refdb
+    @classmethod
+    def setUpClass(cls):
+        # Work on an in-memory copy of the reference database, shared
+        # by all tests through a single connection. Tests which need a
+        # database file use a copy in a temporary directory.
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path_db = shutil.copy(cls.path_refdb, cls.tmpdir.name)
+        cls.db = load_testdb(DB)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+        cls.tmpdir.cleanup()
 
     def setUp(self):
-        # Create a connection to the reference database.
-        self.db = DB()
+        # Changes made in the test (including commits by the DB class,
+        # which are nested as savepoints) are undone in tearDown.
+        self.db.execute("SAVEPOINT test")
 
     def tearDown(self):
-        # Undo changes to the database made in the test.
-        self.db.rollback()
+        self.db.execute("ROLLBACK TO test")
+        self.db.execute("RELEASE test")
 
     # ----------------------------------------------------------------
     # Class-level behaviour.
@@ -47,27 +61,41 @@ class TestDB(unittest.TestCase):
     def test_context(self):
         """Test the context manager functionality.
 
-        Check that database access in context works, and vice versa
-        out of context. The purpose of this test was originally to
-        test a bespoke implementation of context magic methods worked,
-        despite the code now inheriting this behaviour from the
-        `sqlite3.Connection` class.
+        Check that database access in context works and that the
+        connection remains open afterwards. The context is inherited
+        from `sqlite3.Connection` and manages a transaction only; it
+        doesn't close the connection as that may be shared (see
+        `get_connection`).
 
         This test makes no changes to the database and uses a separate
         connection from the one instantiated in setUp.
         """
         stmt = "SELECT 'hello world'"
 
-        with DB() as db:
+        with DB(self.path_db) as db:
             cursor = db.execute(stmt)
             result_set = cursor.fetchall()
 
         self.assertEqual(len(result_set), 1)
+        cursor.execute(stmt)
+        db.close()
+
+    def test_get_connection(self):
+        """Check the shared connection is reused until closed."""
+        db = get_connection(path=self.path_db)
+        self.assertIsInstance(db, DB)
+        self.assertEqual(db.path_db, self.path_db)
+        self.assertIs(get_connection(path=self.path_db), db)
+        self.assertIsNot(get_connection(path=':memory:'), db)
+
+        close_connection(DB)
         self.assertRaises(
             sqlite3.ProgrammingError,
-            cursor.execute,
-            stmt
+            db.execute,
+            "SELECT 'hello world'"
         )
+        self.assertIsNot(get_connection(path=self.path_db), db)
+        close_connection(DB)
 
     def test_expose_conn_attrs(self):
         """Check sqlite3 connection attributes/methods are exposed.
@@ -78,61 +106,100 @@ class TestDB(unittest.TestCase):
         pointless in the event `execute` is implemented as a method
         directly in the `DB` class.
         """
-        db = DB()
+        db = DB(self.path_db)
         db.execute("SELECT 'hello world'")
+        db.close()
+
+    def test_apply_pragmas(self):
+        """Check the connection pragmas are applied on open.
+
+        `synchronous` and `temp_store` report their settings as
+        integers (NORMAL = 1, MEMORY = 2).
+        """
+        db = self.db
+        self.assertEqual(db.execute("PRAGMA synchronous").fetchone(),
+                         (1,))
+        self.assertEqual(db.execute("PRAGMA temp_store").fetchone(),
+                         (2,))
+        self.assertEqual(db.execute("PRAGMA cache_size").fetchone(),
+                         (DB.cache_size,))
 
     # ----------------------------------------------------------------
     # Class component behaviour.
     # ----------------------------------------------------------------
     dt_examples = (
-        ((2000, 1, 1, 18, 0), '2000-01-01 18:00'),
-        ((2000, 1, 1), '2000-01-01 00:00')
+        ((2000, 1, 1, 18, 0), 946749600),
+        ((2000, 1, 1), 946684800)
     )
 
     @data(*dt_examples)
     @unpack
     def test_pydt_to_dbdt(self, pydt, dbdt):
-        """Converts datetime to a string compatible with SQLite TEXT.
+        """Converts datetime to an integer compatible with SQLite.
 
         This static method ensures datetime objects are stored
         correctly in the sqlite database. The specified storage
-        format is:
-
-            YYYY-MM-DD HH:MM
+        format is unix epoch seconds (to the minute), with naive
+        datetimes treated as UTC.
         """
         dt = datetime(*pydt)
         self.assertEqual(DB.pydt_to_dbdt(dt), dbdt)
+        self.assertEqual(DB.pydt_to_dbdt(dt.replace(second=59)), dbdt)
 
     @data(*dt_examples)
     @unpack
     def test_dbdt_to_pydt(self, pydt, dbdt):
-        """Converts SQLite TEXT datetime strings to py datetime.
+        """Converts SQLite INTEGER timestamps to py datetime.
 
         This test checks the inverse of `test_pydt_to_dbdt`.
         """
         dt = datetime(*pydt)
         self.assertEqual(DB.dbdt_to_pydt(dbdt), dt)
 
+    def test_migrate(self):
+        """Tests conversion of a database with TEXT timestamps.
+
+        Databases created before timestamps were stored as integers
+        are converted on open, preserving the contents of the view.
+        """
+        path = os.path.join(self.tmpdir.name, 'text_store.db')
+        conn = sqlite3.connect(path)
+        conn.executescript(
+            """
+            CREATE TABLE quota_history(
+                timestamp TEXT, remaining INT, PRIMARY KEY(timestamp)
+            );
+            CREATE TABLE quota_monthly(
+                month_start TEXT, quota INT, PRIMARY KEY(month_start)
+            );
+            CREATE VIEW quota_vw AS SELECT 1;
+            INSERT INTO quota_history VALUES ('2000-01-01 18:00', 98);
+            INSERT INTO quota_monthly VALUES ('2000-01-01 00:00', 100);
+            """
+        )
+        conn.close()
+
+        db = DB(path)
+        self.assertCountEqual(db.tables(),
+                              ('quota_history', 'quota_monthly'))
+        self.assertListEqual(
+            db.execute("SELECT * FROM quota_vw").fetchall(),
+            [(946749600, 98, 100, 98.0)]
+        )
+        db.close()
+
     def test_create(self):
         """Tests creation of a new database (schema).
 
         Method populates a fresh database.
         """
-        try:
-            DB.path_db = ':memory:'                # Temp db location
-            db = DB()
-            tables = db.tables()
-            self.assertEqual(len(tables), 2)
-            self.assertCountEqual(
-                tables,
-                ('quota_history', 'quota_monthly')
-            )
-            DB.path_db = self.path_refdb           # Reset db location
-        except AssertionError as err:
-            DB.path_db = self.path_refdb
-            raise err
-        except Exception as err:
-            raise err
+        db = DB(':memory:')
+        tables = db.tables()
+        self.assertEqual(len(tables), 2)
+        self.assertCountEqual(
+            tables,
+            ('quota_history', 'quota_monthly')
+        )
 
     @data(
         # 98 GB left of 100 GB allowance on 2000-01-01T18:00
@@ -156,34 +223,156 @@ class TestDB(unittest.TestCase):
         db = self.db
         for quota in quota_list:
             db.insert_quota(*quota)
-            cursor = db.execute(
-                """
-                SELECT *
-                FROM quota_vw
-                WHERE
-                    timestamp = (
-                        SELECT timestamp
-                        FROM quota_history
-                        WHERE rowid = (
-                            SELECT max(rowid)
-                            FROM quota_history
-                        )
-                    )
-                """
-            )
-
-            # Examine the selected record
-            tstamp, rem, tot, pc = cursor.fetchone()
-            self.assertEqual(
-                datetime.strptime(tstamp, DB.dtfmt),
-                quota[0]
-            )
-            self.assertListEqual([rem, tot], list(quota[1:]))
+
+        # Examine the records from the first insert onwards.
+        cursor = db.execute(
+            """
+            SELECT timestamp, remaining, total
+            FROM quota_vw
+            WHERE timestamp >= ?
+            ORDER BY timestamp ASC
+            """,
+            (DB.pydt_to_dbdt(quota_list[0][0]),)
+        )
+        self.assertListEqual(
+            cursor.fetchall(),
+            [(DB.pydt_to_dbdt(dt), rem, tot)
+             for dt, rem, tot in quota_list]
+        )
+
+    def test_insert_quota_commit(self):
+        """Check insertion is committed outside a caller's transaction.
+
+        Within one (as in these tests) it's left to the caller.
+        """
+        self.assertTrue(self.db.in_transaction)
+        db = DB(':memory:')
+        db.insert_quota(datetime(2003, 1, 1, 18), 97500000000,
+                        100000000000)
+        self.assertFalse(db.in_transaction)
+        db.close()
+
+    def test_batch(self):
+        """Check inserts in a batch are committed together."""
+        db = DB(':memory:')
+        with db.batch():
+            db.insert_quota(datetime(2003, 1, 1, 18), 97500000000,
+                            100000000000)
+            db.insert_quota(datetime(2003, 1, 1, 19), 97000000000,
+                            100000000000)
+            self.assertTrue(db.in_transaction)
+            db.flush()
+            self.assertTrue(db.in_transaction)
+        self.assertFalse(db.in_transaction)
+
+        # A failure rolls back anything not yet flushed.
+        with self.assertRaises(RuntimeError):
+            with db.batch():
+                db.insert_quota(datetime(2003, 1, 1, 20), 96500000000,
+                                100000000000)
+                raise RuntimeError
+        count = db.execute("SELECT count(*) FROM quota_history")
+        self.assertEqual(count.fetchone(), (2,))
+        db.close()
+
+    def test_insert_quota_notify(self):
+        """Check observers are invalidated once data is committed.
+
+        Within a transaction (as in these tests), that's left to the
+        caller's commit.
+        """
+        observer = Mock()
+        DB.observers.add(observer)
+        db = DB(':memory:')
+        try:
+            self.db.insert_quota(datetime(2003, 1, 1, 18),
+                                 97500000000,
+                                 100000000000)
+            observer.invalidate.assert_not_called()
+            db.insert_quota(datetime(2003, 1, 1, 18), 97500000000,
+                            100000000000)
+        finally:
+            DB.observers.discard(observer)
+            db.close()
+        observer.invalidate.assert_called_once_with()
+
+    def test_batch_notify(self):
+        """Check observers are invalidated on commit and rollback.
+
+        Data read during a batch is invalid once it's rolled back.
+        """
+        observer = Mock()
+        DB.observers.add(observer)
+        db = DB(':memory:')
+        try:
+            with self.assertRaises(RuntimeError):
+                with db.batch():
+                    db.insert_quota(datetime(2003, 1, 1, 18),
+                                    97500000000, 100000000000)
+                    observer.invalidate.assert_not_called()
+                    raise RuntimeError
+            observer.invalidate.assert_called_once_with()
+
+            with db.batch():
+                db.insert_quota(datetime(2003, 1, 1, 18), 97500000000,
+                                100000000000)
+                db.flush()
+                self.assertEqual(observer.invalidate.call_count, 2)
+            self.assertEqual(observer.invalidate.call_count, 3)
+        finally:
+            DB.observers.discard(observer)
+            db.close()
+
+    def test_batch_nested(self):
+        """Check a batch can't be started in an open transaction."""
+        with self.assertRaises(sqlite3.ProgrammingError):
+            with self.db.batch():
+                pass
+        self.assertTrue(self.db.in_transaction)
+
+    def test_insert_quota_rollback(self):
+        """Check a failed insertion is rolled back and re-raised."""
+        db = self.db
+        count = "SELECT count(*) FROM quota_history"
+        n_before = db.execute(count).fetchone()[0]
+        with patch.object(DB, '_insert_quota_monthly',
+                          side_effect=sqlite3.OperationalError):
+            self.assertRaises(sqlite3.OperationalError,
+                              db.insert_quota,
+                              datetime(2003, 1, 1, 18),
+                              97500000000,
+                              100000000000)
+        self.assertEqual(db.execute(count).fetchone()[0], n_before)
+
+    def test_insert_quota_many(self):
+        """Handles insertion of several quota records at once."""
+        quota_list = [
+            (datetime(2003, 1, 1, 18), 98000000000, 100000000000),
+            (datetime(2003, 1, 2, 18), 97500000000, 100000000000),
+            (datetime(2003, 2, 1, 18), 99500000000, 200000000000),
+        ]
+        db = self.db
+        db.insert_quota_many(reversed(quota_list))
+        cursor = db.execute(
+            """
+            SELECT timestamp, remaining, total
+            FROM quota_vw
+            WHERE timestamp >= ?
+            ORDER BY timestamp ASC
+            """,
+            (DB.pydt_to_dbdt(datetime(2003, 1, 1)),)
+        )
+        self.assertListEqual(
+            cursor.fetchall(),
+            [(DB.pydt_to_dbdt(dt), rem, tot)
+             for dt, rem, tot in quota_list]
+        )
 
     def test_tables(self):
         """Check that the list of tables in ref. db is as expected."""
-        with DB() as db:
+        with DB(self.path_db) as db:
             tables = db.tables()
+        db.close()
 
         # NOTE: assertItemsEqual replaced by assertCountEqual in Py3.2
         self.assertCountEqual(
@@ -1,16 +1,101 @@
 import unittest
-from unittest.mock import patch
+import os
+import tempfile
+from unittest.mock import patch, Mock
 
 from ddt import ddt as DDT, data, unpack
+import pandas
 
+import aachaos.get
 import aachaos.vis
-from aachaos.tests.test_get import PATH_TESTDB
+from aachaos.tests.test_get import PATH_TESTDB, load_testdb
 
 
 @DDT
 class TestPlotter(unittest.TestCase):
 
-    pass
+    def test__create(self):
+        """Figures are written in full before replacing the file."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fpath = os.path.join(tmpdir, 'fig.svg')
+            with open(fpath, 'w') as f:
+                f.write('old')
+
+            def savefig(path, format, **kwargs):
+                self.assertEqual(kwargs, {'metadata': {'Date': None}})
+                with open(path, 'w') as f:
+                    f.write(format)
+                with open(fpath) as f:
+                    self.assertEqual(f.read(), 'old')
+
+            with patch.object(aachaos.vis.Plotter, 'plt') as mock_plt:
+                mock_plt.savefig.side_effect = savefig
+                aachaos.vis.Plotter()._create(fpath)
+
+            self.assertEqual(os.listdir(tmpdir), ['fig.svg'])
+            with open(fpath) as f:
+                self.assertEqual(f.read(), 'svg')
+
+    def test__create_error(self):
+        """A failed save leaves the existing figure alone."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fpath = os.path.join(tmpdir, 'fig.svg')
+            with open(fpath, 'w') as f:
+                f.write('old')
+
+            def savefig(path, format, **kwargs):
+                with open(path, 'w') as f:
+                    f.write('partial')
+                raise OSError
+
+            with patch.object(aachaos.vis.Plotter, 'plt') as mock_plt:
+                mock_plt.savefig.side_effect = savefig
+                self.assertRaises(OSError, aachaos.vis.Plotter()._create,
+                                  fpath)
+
+            self.assertEqual(os.listdir(tmpdir), ['fig.svg'])
+            with open(fpath) as f:
+                self.assertEqual(f.read(), 'old')
+
+    def test_plot_month(self):
+        """A month is plotted from the given history."""
+        history = aachaos.get.History(load_testdb())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fpath = os.path.join(tmpdir, 'fig.svg')
+            fig, usage_linear = aachaos.vis.Plotter().plot_month(
+                '2001-01', fpath, history=history
+            )
+            self.assertTrue(os.path.isfile(fpath))
+        self.assertEqual(usage_linear.iloc[0], 100)
+        self.assertNotIn(fig.number, aachaos.vis.Plotter.plt.get_fignums())
+
+    @data(
+        # January 2001 starts on a Monday.
+        ('2001-01-01', '2001-02-01',
+         [('2001-01-06', '2001-01-08'), ('2001-01-13', '2001-01-15'),
+          ('2001-01-20', '2001-01-22'), ('2001-01-27', '2001-01-29')]),
+        # Starting on a Sunday, ending on a Saturday.
+        ('2001-01-07', '2001-01-13', [('2001-01-07', '2001-01-08')]),
+    )
+    @unpack
+    def test__shade_weekends(self, start, end, spans):
+        """Weekends within the plotted lines' range are shaded."""
+        line = Mock()
+        line.get_xdata.return_value = pandas.period_range(
+            start, end, freq='h'
+        ).to_numpy()
+        axes = Mock()
+        axes.get_lines.return_value = [line]
+
+        aachaos.vis.Plotter()._shade_weekends(axes)
+
+        self.assertEqual(
+            [(c.kwargs['xmin'], c.kwargs['xmax'])
+             for c in axes.axvspan.call_args_list],
+            [(pandas.Timestamp(a), pandas.Timestamp(b))
+             for a, b in spans]
+        )
+
     # TODO: Fix this testing, plt is now a class attribute.
     #aachaos.vis.aachaos.get.DB.path_db = PATH_TESTDB
     #@patch('aachaos.vis.plt.savefig')
@@ -7,29 +7,36 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 
-import matplotlib as mpl
-
 import aachaos.get
 
 
 class Plotter(object):
 
+    # matplotlib.pyplot, set up on first use by `_import_pyplot`.
+    plt = None
+
     def _import_pyplot(self, interactive=True):
+        # matplotlib is imported here rather than at module level so
+        # importing this module (e.g. from `main`) stays cheap.
+        mpl = importlib.import_module('matplotlib')
         if interactive:
             # Use default backend
             pass
         else:
+            # No-op if already selected.
             mpl.use('agg')
 
-        # Configure plotting style and assign module to attribute.
-        self.plt =  importlib.import_module('matplotlib.pyplot')
-        mpl.style.use('ggplot')
+        # Configure plotting style and assign module to the class
+        # attribute, once for all instances.
+        if Plotter.plt is None:
+            plt = importlib.import_module('matplotlib.pyplot')
+            plt.style.use('ggplot')
+            Plotter.plt = plt
 
     # ----------------------------------------------------------------
     # External methods
     # ----------------------------------------------------------------
-    def plot_month(self, month=datetime.today().strftime('%Y-%m'),
-                   fpath=None):
+    def plot_month(self, month=None, fpath=None, history=None):
         """Plot data for the specified month.
 
         If there is no data, no figure will be generated and a warning
@@ -44,14 +51,22 @@ class Plotter(object):
             fpath : string (optional)
                 Output file path (extension controls format). If not
                 specified, default behaviour is to display the figure.
+
+            history : aachaos.get.History (optional)
+                Source of the data, e.g. to reuse one whose data is
+                already loaded. By default, one is created on the
+                shared database connection.
         """
         self._import_pyplot(fpath is None)
 
         # TODO: Separate data generation from plotting.
+        if month is None:
+            month = datetime.today().strftime('%Y-%m')
         month = pd.Period(month)
         next_month = month + 1
 
-        history = aachaos.get.History()
+        if history is None:
+            history = aachaos.get.History()
         usage = history.by_month(month, units='GB')
         #usage = history.usage('GB')
         quota = history.quota(units='GB')[month]
@@ -63,34 +78,33 @@ class Plotter(object):
         #usage = usage[usage.index >= month.start_time]
         #usage = usage[usage.index < next_month.start_time]
 
-        usage_linear = pd.Series(
-           np.nan,
-           index=pd.DatetimeIndex(
-               start=month.start_time,
-               end=next_month.start_time,
-               freq='H'
-           )
-        )
-        usage_linear[0] = quota
-        usage_linear[-1] = 0
-        usage_linear = usage_linear.interpolate()
-
-        # Ensure we have a value at the start of the month.
+        # Straight line from the full quota down to zero.
+        index = pd.date_range(month.start_time, next_month.start_time,
+                              freq='h')
+        usage_linear = pd.Series(np.linspace(quota, 0.0, len(index)),
+                                 index=index)
+
+        # Ensure we have a value at the start of the month (the first
+        # point of the linear usage).
         if usage.index[0] != month.start_time:
-            a = usage_linear[usage_linear.index == month.start_time]
-            usage = pd.concat((a, usage))
+            usage = pd.concat((usage_linear.iloc[:1], usage))
 
         fig, axes = self.plt.subplots()
         usage_linear.plot(ax=axes, color='0.6', linestyle='--')
         self._shade_weekends(axes)
 
-        usage.plot(ax=axes, linestyle='-', color='#005E10')
-        usage.plot(ax=axes, color='#A30A0A', style='.',
-                   alpha=0.5)
+        # Line and (semi-transparent) markers as a single artist.
+        usage.plot(ax=axes, style='.-', color='#005E10',
+                   markerfacecolor='#A30A0A80',
+                   markeredgecolor='#A30A0A80')
 
         axes.set_ylabel('Quota [GB]')
 
         self._create(fpath)
+        if fpath is not None:
+            # Release the saved figure; pyplot otherwise keeps every
+            # figure alive in a long-running process.
+            self.plt.close(fig)
 
         return fig, usage_linear
 
@@ -98,9 +112,24 @@ class Plotter(object):
     # Internal methods
     # ----------------------------------------------------------------
     def _create(self, fpath=None):
-        # Thin wrapper around either savefig or show
+        # Thin wrapper around either savefig or show. Files are written
+        # alongside and moved into place, so readers (e.g. the webapp)
+        # never see a partially written figure.
         if fpath is not None and isinstance(fpath, str):
-            self.plt.savefig(fpath)
+            fmt = (os.path.splitext(fpath)[1][1:]
+                   or self.plt.rcParams['savefig.format'])
+            # Leave the creation date out of SVGs, so unchanged data
+            # gives an identical file.
+            kwargs = {'metadata': {'Date': None}} if fmt == 'svg' else {}
+            tmp_path = '.'.join([fpath, 'tmp'])
+            try:
+                self.plt.savefig(tmp_path, format=fmt, **kwargs)
+                os.replace(tmp_path, fpath)
+            except BaseException:
+                # Don't leave a partial figure behind.
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
         else:
             self.plt.show()
 
@@ -112,38 +141,15 @@ class Plotter(object):
         for func in min, max:
             limit[func.__name__] = func(map(func, xdata)).start_time
 
-        index = pd.DatetimeIndex(start=limit['min'], end=limit['max'],
-                                 freq='D')
-
-        df = pd.DataFrame(
-            data=index.map(lambda d: d.weekday() >= 5),
-            index=index,
-            columns=('weekend',)
-        )
-
-        # Strip initial weekdays, we want the first entry to be a
-        # weekend so it can be zipped using a single approach later.
-        df = df[df.index >= df[df.weekend].index.min()]
-
-        # Identify contiguous blocks (boolean) and assign an ID based
-        # on the cumulative summation in a new column. The ID means we
-        # can group it by block as well as status as weekend or not.
-        we = df.weekend
-        df['blockID'] = (we.shift(1) != we).astype(int).cumsum()
-
-        # Group with a multi-index (weekend = 1, blockID = 2).
-        df = df.reset_index()
-        df = df.groupby(['weekend', 'blockID'])['index']
-        df = df.apply(list)
-
-        # We now have timestamps split into contiguous blocks,
-        # classified by weekend/non-weekend. If we interleave these
-        # two top-level lists (starting with weekend) and take the
-        # head of each list/block of timestamps in each pair, we have
-        # the start/end timestamps for each weekend.
-        spans = []
-        for wkend_tstamps, wkday_tstamps in zip(df[True], df[False]):
-            spans.append((wkend_tstamps[0], wkday_tstamps[0]))
+        days = pd.date_range(limit['min'], limit['max'], freq='D')
+        weekend = days.weekday >= 5
+
+        # Weekends start where the flag switches on (including on the
+        # first day) and end where it switches off. Pairing starts with
+        # ends in order gives the span of each weekend; one still
+        # running at the end of the range has no end and is dropped.
+        change = np.diff(weekend.astype(np.int8), prepend=0)
+        spans = zip(days[change == 1], days[change == -1])
 
         for start, end in spans:
             axes.axvspan(xmin=start, xmax=end, color='0.80', alpha=0.5)
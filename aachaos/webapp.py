@@ -7,7 +7,6 @@ from aachaos.config import settings
 
 
 FIG_PATH = settings.get('Path', 'Figure')
-TMP_PATH = '.'.join([FIG_PATH, 'tmp'])
 
 
 class QuasiStaticHandler(tornado.web.StaticFileHandler):
@@ -25,8 +24,11 @@ def make_app():
 
 
 def create_figure():
+    # The figure is normally rendered by `main update` each time a
+    # data point is collected; requests only ever read the file.
+    from aachaos import vis
     plotter = vis.Plotter()
-    plotter.plot_month()
+    plotter.plot_month(fpath=FIG_PATH)
 
 
 if __name__ == "__main__":